@@ -1,25 +1,24 @@
 from typing import List, Optional
 from datetime import date
 import pandas as pd
-import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from anndata import AnnData
 from pyro import clear_param_store
+from pyro.infer import JitTrace_ELBO, JitTraceMeanField_ELBO, Trace_ELBO, TraceMeanField_ELBO
 from scvi.model._utils import parse_use_gpu_arg
 from scvi.dataloaders import AnnDataLoader
+from scvi.dataloaders._data_splitting import validate_data_split
 from scvi.utils import track
 from scvi import REGISTRY_KEYS
 from scvi.data import AnnDataManager
 from scvi.data.fields import (
     CategoricalObsField,
     LayerField,
-    NumericalJointObsField,
     NumericalObsField,
 )
 from scvi.model.base import BaseModelClass, PyroSampleMixin, PyroSviTrainMixin
 from scvi.utils import setup_anndata_dsp
-import pyro.distributions as dist
 import torch
 import scanpy as sc
 import contextlib
@@ -30,15 +29,13 @@ from numpy import inner
 import scvelo as scv
 from scvelo.plotting.velocity_embedding_grid import compute_velocity_on_grid
 from ._velocity_embedding_stream import velocity_embedding_stream_modules
-import scipy
-import gseapy as gp
 from cell2fate._pyro_base_cell2fate_module import Cell2FateBaseModule
 from cell2fate._pyro_mixin import QuantileMixin
 from ._cell2fate_DynamicalModel_module import \
 Cell2fate_DynamicalModel_module
 from cell2fate.utils import multiplot_from_generator
 
-from cell2fate.utils import mu_mRNA_continousAlpha_globalTime_twoStates
+from cell2fate.utils import mu_mRNA_continousAlpha_globalTime_twoStates, compute_velocity
 import cell2fate as c2f
 
 class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin, BaseModelClass):
@@ -107,7 +104,7 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         %(param_labels_key)s
         """
         setup_method_args = cls._get_setup_method_args(**locals())
-        adata.obs["_indices"] = np.arange(adata.n_obs).astype("int64")
+        adata.obs["_indices"] = np.arange(adata.n_obs, dtype="int64")
         if cluster_label:
             anndata_fields = [
                 LayerField('unspliced', unspliced_label, is_count_data=True),
@@ -133,6 +130,9 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         batch_size: int = 1000,
         train_size: float = 1,
         lr: float = 0.01,
+        jit: bool = False,
+        num_particles: int = 1,
+        mean_field: bool = False,
         **kwargs,
     ):
         """
@@ -151,6 +151,20 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         lr
             Optimiser learning rate (default optimiser is :class:`~pyro.optim.ClippedAdam`).
             Specifying optimiser via plan_kwargs overrides this choice of lr.
+        jit
+            Compile model and guide with :class:`~pyro.infer.JitTrace_ELBO`. The first step is slower
+            while the graph is traced, subsequent steps avoid the Python overhead of re-tracing the model.
+            The trace is compiled once for the shapes of the first minibatch, so it is only used when all
+            training and validation minibatches have the same size (e.g. ``batch_size`` divides the number of
+            cells and ``train_size = 1``); otherwise the non-compiled ELBO is used.
+            Specifying ``loss_fn`` via plan_kwargs overrides this choice.
+        num_particles
+            Number of samples used to estimate the ELBO in each step. More particles give lower variance gradients
+            at a proportional cost per step.
+        mean_field
+            Use :class:`~pyro.infer.TraceMeanField_ELBO`, which uses analytic KL divergences where available
+            to reduce gradient variance. Combined with ``jit`` this uses :class:`~pyro.infer.JitTraceMeanField_ELBO`,
+            subject to the same minibatch size condition.
         kwargs
             Other arguments to :py:meth:`scvi.model.base.PyroSviTrainMixin().train` method
         """
@@ -160,8 +174,42 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         kwargs["batch_size"] = batch_size
         kwargs["train_size"] = train_size
         kwargs["lr"] = lr
+        if jit and len(self._minibatch_sizes(batch_size, train_size, kwargs.get("validation_size"))) > 1:
+            print('Warning: minibatches have different sizes, training without jit. '
+                  'Choose a batch_size that divides the number of cells to use jit.')
+            jit = False
+        if jit or mean_field or num_particles > 1:
+            if mean_field:
+                elbo = JitTraceMeanField_ELBO if jit else TraceMeanField_ELBO
+            else:
+                elbo = JitTrace_ELBO if jit else Trace_ELBO
+            elbo_kwargs = {"num_particles": num_particles}
+            if jit:
+                elbo_kwargs["ignore_jit_warnings"] = True
+            plan_kwargs = dict(kwargs.pop("plan_kwargs", None) or {})
+            plan_kwargs.setdefault("loss_fn", elbo(**elbo_kwargs))
+            kwargs["plan_kwargs"] = plan_kwargs
 
         super().train(**kwargs)
+
+    def _minibatch_sizes(self, batch_size, train_size, validation_size=None):
+        """
+        Sizes of the minibatches yielded by the training and validation dataloaders of scvi's ``DataSplitter``,
+        which drops a last minibatch smaller than 3 cells.
+        """
+        n_train, n_val = validate_data_split(self.adata.n_obs, train_size, validation_size)
+        sizes = set()
+        for n in (n_train, n_val):
+            if n == 0:
+                continue
+            if batch_size is None:
+                sizes.add(n)
+                continue
+            if n >= batch_size:
+                sizes.add(batch_size)
+            if n % batch_size >= 3:
+                sizes.add(n % batch_size)
+        return sizes
         
     def _export2adata(self, samples):
         r"""
@@ -181,8 +229,8 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         results = {
             "model_name": str(self.module.__class__.__name__),
             "date": str(date.today()),
-            "var_names": self.adata.var_names.tolist(),
-            "obs_names": self.adata.obs_names.tolist(),
+            "var_names": self.adata.var_names.to_numpy(copy=True),
+            "obs_names": self.adata.obs_names.to_numpy(copy=True),
             "post_sample_means": samples["post_sample_means"],
             "post_sample_stds": samples["post_sample_stds"],
             "post_sample_q05": samples["post_sample_q05"],
@@ -209,8 +257,8 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         results = {
             "model_name": str(self.module.__class__.__name__),
             "date": str(date.today()),
-            "var_names": self.adata.var_names.tolist(),
-            "obs_names": self.adata.obs_names.tolist(),
+            "var_names": self.adata.var_names.to_numpy(copy=True),
+            "obs_names": self.adata.obs_names.to_numpy(copy=True),
             "post_q25": samples["0.25"],
             "post_q50": samples["0.5"],
             "post_q75": samples["0.75"],
@@ -266,42 +314,37 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
             AnnData object with additional module-related summary statistics.
         """
         
-        
-        if scipy.sparse.issparse(self.adata_manager.get_from_registry('unspliced')):
-            observed_total = torch.sum(torch.sum(torch.stack([torch.tensor(self.adata_manager.get_from_registry('unspliced').toarray()),
-                          torch.tensor(self.adata_manager.get_from_registry('spliced').toarray())], axis = -1), axis = -1), axis = -1)
-        else:
-            observed_total = torch.sum(torch.sum(torch.stack([torch.tensor(self.adata_manager.get_from_registry('unspliced')),
-                          torch.tensor(self.adata_manager.get_from_registry('spliced'))], axis = -1), axis = -1), axis = -1)
-        inferred_total = torch.sum(torch.sum(torch.tensor(self.samples['post_sample_means']['mu_expression']), axis = -1), axis = -1)
+        post_means = self.samples['post_sample_means']
+        beta_g = torch.tensor(post_means['beta_g'])
+        gamma_g = torch.tensor(post_means['gamma_g'])
+        T_c = torch.tensor(post_means['T_c'][:,:,0])
+        zeros = torch.zeros((self.module.model.n_obs, self.module.model.n_vars))
+        obs_columns = {}
         for m in range(self.module.model.n_modules):
+            A_gON = torch.tensor(post_means['A_mgON'][m,:])
             mu_m = mu_mRNA_continousAlpha_globalTime_twoStates(
-                torch.tensor(self.samples['post_sample_means']['A_mgON'][m,:]),
+                A_gON,
                 torch.tensor(0.),
-                torch.tensor(self.samples['post_sample_means']['beta_g']),
-                torch.tensor(self.samples['post_sample_means']['gamma_g']),
-                torch.tensor(self.samples['post_sample_means']['lam_mi'][m,:]),
-                torch.tensor(self.samples['post_sample_means']['T_c'][:,:,0]),
-                torch.tensor(self.samples['post_sample_means']['T_mON'][:,:,m]),
-                torch.tensor(self.samples['post_sample_means']['T_mOFF'][:,:,m]),
-                torch.zeros((self.module.model.n_obs, self.module.model.n_vars)))
-            ss_total = torch.sum(torch.tensor(self.samples['post_sample_means']['A_mgON'][m,:])/torch.tensor(self.samples['post_sample_means']['gamma_g']) + \
-        torch.tensor(self.samples['post_sample_means']['A_mgON'][m,:])/torch.tensor(self.samples['post_sample_means']['beta_g']), axis = 1)
-            adata.obs['Module ' + str(m) + ' Activation'] = torch.sum(torch.sum(mu_m, axis = -1), axis = -1)/ss_total
-            adata.obs['Module ' + str(m) + ' State'] = 'OFF'
-            adata.obs['Module ' + str(m) + ' State'
-             ][self.samples['post_sample_means']['T_c'][:,0,0] > self.samples['post_sample_means']['T_mON'][0,0,m]
-              ] = 'Induction'
-            adata.obs['Module ' + str(m) + ' State'
-             ][self.samples['post_sample_means']['T_c'][:,0,0] > self.samples['post_sample_means']['T_mOFF'][0,0,m]
-              ] = 'Repression'
-            adata.obs['Module ' + str(m) + ' State'
-             ][adata.obs['Module ' + str(m) + ' Activation'] > 0.95
-              ] = 'ON'
-            adata.obs['Module ' + str(m) + ' State'
-             ][adata.obs['Module ' + str(m) + ' Activation'] < 0.05
-              ] = 'OFF'
-            adata.obs['Module ' + str(m) + ' Activation'] = torch.sum(torch.sum(mu_m, axis = -1), axis = -1)
+                beta_g,
+                gamma_g,
+                torch.tensor(post_means['lam_mi'][m,:]),
+                T_c,
+                torch.tensor(post_means['T_mON'][:,:,m]),
+                torch.tensor(post_means['T_mOFF'][:,:,m]),
+                zeros)
+            ss_total = torch.sum(A_gON/gamma_g + A_gON/beta_g, axis = 1)
+            activation = torch.sum(torch.sum(mu_m, axis = -1), axis = -1)
+            relative_activation = (activation/ss_total).numpy()
+            state = np.full(len(relative_activation), 'OFF', dtype = object)
+            state[post_means['T_c'][:,0,0] > post_means['T_mON'][0,0,m]] = 'Induction'
+            state[post_means['T_c'][:,0,0] > post_means['T_mOFF'][0,0,m]] = 'Repression'
+            state[relative_activation > 0.95] = 'ON'
+            state[relative_activation < 0.05] = 'OFF'
+            obs_columns['Module ' + str(m) + ' Activation'] = activation.numpy()
+            obs_columns['Module ' + str(m) + ' State'] = state
+        # add all module columns to adata.obs in a single step:
+        obs_columns = pd.DataFrame(obs_columns, index = adata.obs_names)
+        adata.obs = pd.concat([adata.obs.drop(columns = obs_columns.columns, errors = 'ignore'), obs_columns], axis = 1)
         return adata
 
     def plot_module_summary_statistics(self, adata, save = None):
@@ -388,8 +431,9 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
             print('Warning: Saving ALL posterior samples. Specify "return_samples: False" to save just summary statistics.')
             adata.uns[export_slot]['post_samples'] = self.samples['posterior_samples']
 
-        adata.obs['Time (hours)'] = self.samples['post_sample_means']['T_c'].flatten() - np.min(self.samples['post_sample_means']['T_c'].flatten())
-        adata.obs['Time Uncertainty (sd)'] = self.samples['post_sample_stds']['T_c'].flatten()
+        T_c = self.samples['post_sample_means']['T_c'].ravel()
+        adata.obs['Time (hours)'] = T_c - np.min(T_c)
+        adata.obs['Time Uncertainty (sd)'] = self.samples['post_sample_stds']['T_c'].ravel()
         
 #         adata.layers['spliced mean'] = self.samples['post_sample_means']['mu_expression'][...,1]
 #         adata.layers['velocity'] = torch.tensor(self.samples['post_sample_means']['beta_g']) * \
@@ -445,22 +489,24 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
 
         self.samples = {}
         self.samples['post_sample_means'] = quantiles_dict["0.5"]
-        adata.obs['Time (hours)'] = self.samples['post_sample_means']['T_c'].flatten() - np.min(self.samples['post_sample_means']['T_c'].flatten())
+        T_c = self.samples['post_sample_means']['T_c'].ravel()
+        adata.obs['Time (hours)'] = T_c - np.min(T_c)
         
 
-        adata.obs['Time Uncertainty (QCD)'] = (quantiles_dict['0.75']['T_c'].flatten() - quantiles_dict['0.25']['T_c'].flatten())/ (quantiles_dict['0.25']['T_c'].flatten() + quantiles_dict['0.75']['T_c'].flatten())
+        T_c_q25 = quantiles_dict['0.25']['T_c'].ravel()
+        T_c_q75 = quantiles_dict['0.75']['T_c'].ravel()
+        adata.obs['Time Uncertainty (QCD)'] = (T_c_q75 - T_c_q25)/ (T_c_q25 + T_c_q75)
         
         
         adata.layers['spliced mean'] = self.samples['post_sample_means']['mu_expression'][...,1]
-        adata.layers['velocity'] = torch.tensor(self.samples['post_sample_means']['beta_g']) * \
-        self.samples['post_sample_means']['mu_expression'][...,0] - \
-        torch.tensor(self.samples['post_sample_means']['gamma_g']) * \
-        self.samples['post_sample_means']['mu_expression'][...,1]
+        adata.layers['velocity'] = compute_velocity(self.samples['post_sample_means']['beta_g'],
+                                                    self.samples['post_sample_means']['gamma_g'],
+                                                    self.samples['post_sample_means']['mu_expression'])
 
         return adata
 
     def compute_velocity_graph_Bergen2020(mod, adata, n_neighbours = None, full_posterior = True, spliced_key = 'Ms',
-                                          velocity_key = 'velocity'):
+                                          velocity_key = 'velocity', recompute_neighbours = True):
         """
         Computes a "velocity graph" similar to the method in:
         "Bergen et al. (2020), Generalizing RNA velocity to transient cell states through dynamical modeling"
@@ -479,6 +525,9 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
             Key to access velocity information in adata.
         spliced_key
             Key to access normalized spliced counts in adata.
+        recompute_neighbours
+            Whether to recompute the nearest neighbour graph. If False, the graph in ``adata.obsp['binary']``
+            from a previous call on the same data is reused (if present).
 
         Returns
         -------
@@ -488,34 +537,28 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         M = len(adata.obs_names)
         if not n_neighbours:
             n_neighbours = int(np.round(M*0.05, 0))
-        scv.pp.neighbors(adata, n_neighbors = n_neighbours)
-        adata.obsp['binary'] = adata.obsp['connectivities'] != 0
-        distances = []
-        velocities = []
-        cosines = []
-        transition_probabilities = []
-        matrices = []
-        if full_posterior:
-            for i in range(M):
-                distances += [adata.layers[spliced_key][adata.obsp['binary'].toarray()[i,:],:] - adata.layers[spliced_key][i,:].flatten()]
-                velocities += [adata.uns['velocity_posterior'][:,i,:]]
-                cosines += [inner(distances[i], velocities[i])/(norm(distances[i])*norm(velocities[i]))]
-                transition_probabilities += [np.exp(2*cosines[i])]
-                transition_probabilities[i] = transition_probabilities[i]/np.sum(transition_probabilities[i], axis = 0)
-                matrices += [csr_matrix((np.mean(np.array(transition_probabilities[i]), axis = 1),
-                        (np.repeat(i, len(transition_probabilities[i])), np.where(adata.obsp['binary'][i,:].toarray())[1])),
-                                       shape=(M, M))]
-        else:
-            for i in range(M):
-                distances += [adata.layers[spliced_key][adata.obsp['binary'].toarray()[i,:],:] - adata.layers[spliced_key][i,:].flatten()]
-                velocities += [adata.layers[velocity_key][i,:].reshape(1,len(adata.var_names))]
-                cosines += [inner(distances[i], velocities[i])/(norm(distances[i])*norm(velocities[i]))]
-                transition_probabilities += [np.exp(2*cosines[i])]
-                transition_probabilities[i] = transition_probabilities[i]/np.sum(transition_probabilities[i], axis = 0)
-                matrices += [csr_matrix((np.mean(np.array(transition_probabilities[i]), axis = 1),
-                        (np.repeat(i, len(transition_probabilities[i])), np.where(adata.obsp['binary'][i,:].toarray())[1])),
-                                       shape=(M, M))]
-        return sum(matrices)
+        if recompute_neighbours or 'binary' not in adata.obsp.keys():
+            scv.pp.neighbors(adata, n_neighbors = n_neighbours)
+            adata.obsp['binary'] = adata.obsp['connectivities'] != 0
+        binary = csr_matrix(adata.obsp['binary'])
+        rows = []
+        cols = []
+        values = []
+        for i in range(M):
+            # neighbours of cell i read from the sparse graph (avoids densifying the M x M graph):
+            neighbours = binary.indices[binary.indptr[i]:binary.indptr[i+1]]
+            distances = adata.layers[spliced_key][neighbours,:] - adata.layers[spliced_key][i,:].flatten()
+            if full_posterior:
+                velocities = adata.uns['velocity_posterior'][:,i,:]
+            else:
+                velocities = adata.layers[velocity_key][i,:].reshape(1,len(adata.var_names))
+            cosines = inner(distances, velocities)/(norm(distances)*norm(velocities))
+            transition_probabilities = np.exp(2*cosines)
+            transition_probabilities = transition_probabilities/np.sum(transition_probabilities, axis = 0)
+            rows += [np.repeat(i, len(transition_probabilities))]
+            cols += [neighbours]
+            values += [np.mean(transition_probabilities, axis = 1)]
+        return csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(M, M))
 
     def compute_and_plot_module_velocity(self, adata, delete = True, plot = True, save = None,
                                      plotting_kwargs = {"color": 'clusters', 'legend_fontsize': 10,
@@ -560,17 +603,19 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
                     problem_cells_index = count_sum == torch.min(count_sum)
                     
                     
-                    mu_m[problem_cells_index,:,0] = torch.tensor(np.random.sample(n_problem_cells)).unsqueeze(-1)*\
+                    mu_m[problem_cells_index,:,0] = torch.tensor(np.random.sample(n_problem_cells), dtype = torch.float).unsqueeze(-1)*\
                     torch.tensor(self.samples['post_sample_means']['mu_expression'][problem_cells_index,:,0])*torch.tensor(10**(-5))
-                    mu_m[problem_cells_index,:,1] = torch.tensor(np.random.sample(n_problem_cells)).unsqueeze(-1)*\
+                    mu_m[problem_cells_index,:,1] = torch.tensor(np.random.sample(n_problem_cells), dtype = torch.float).unsqueeze(-1)*\
                     torch.tensor(self.samples['post_sample_means']['mu_expression'][problem_cells_index,:,1])*torch.tensor(10**(-5))
-                adata.layers['Module ' + str(m) + 'Spliced Mean'] = mu_m[...,1]
-                adata.layers['Module ' + str(m) + ' Velocity'] = torch.tensor(self.samples['post_sample_means']['beta_g']) * \
-                mu_m[...,0] - torch.tensor(self.samples['post_sample_means']['gamma_g']) * mu_m[...,1]
+                adata.layers['Module ' + str(m) + 'Spliced Mean'] = mu_m[...,1].numpy()
+                adata.layers['Module ' + str(m) + ' Velocity'] = compute_velocity(self.samples['post_sample_means']['beta_g'],
+                                                                                  self.samples['post_sample_means']['gamma_g'],
+                                                                                  mu_m.numpy())
                 adata.uns['Module ' + str(m) + ' Velocity' + '_graph'] = self.compute_velocity_graph_Bergen2020(
                                                        adata, n_neighbours = None, full_posterior = False,
                                                        velocity_key = 'Module ' + str(m) + ' Velocity',
-                                                       spliced_key = 'Module ' + str(m) + 'Spliced Mean')
+                                                       spliced_key = 'Module ' + str(m) + 'Spliced Mean',
+                                                       recompute_neighbours = m == 0)
                 if plot:
                     try:
                         scv.pl.velocity_embedding_stream(adata, basis='umap', save = False, vkey='Module ' + str(m) + ' Velocity',
@@ -613,10 +658,9 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
 
         with contextlib.redirect_stdout(io.StringIO()):
             adata.layers['Spliced Mean'] = self.samples['post_sample_means']['mu_expression'][...,1]
-            adata.layers['Velocity'] = torch.tensor(self.samples['post_sample_means']['beta_g']) * \
-            self.samples['post_sample_means']['mu_expression'][...,0] - \
-            torch.tensor(self.samples['post_sample_means']['gamma_g']) * \
-            self.samples['post_sample_means']['mu_expression'][...,1]
+            adata.layers['Velocity'] = compute_velocity(self.samples['post_sample_means']['beta_g'],
+                                                        self.samples['post_sample_means']['gamma_g'],
+                                                        self.samples['post_sample_means']['mu_expression'])
             adata.uns['Velocity' + '_graph'] = self.compute_velocity_graph_Bergen2020(
                                                    adata, n_neighbours = None, full_posterior = False,
                                                    velocity_key = 'Velocity',
@@ -660,10 +704,9 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         with contextlib.redirect_stdout(io.StringIO()):
             adata.layers['Mu'] = self.samples['post_sample_means']['mu_expression'][...,0]
             adata.layers['Ms'] = self.samples['post_sample_means']['mu_expression'][...,1]
-            adata.layers['velocity'] = torch.tensor(self.samples['post_sample_means']['beta_g']) * \
-            self.samples['post_sample_means']['mu_expression'][...,0] - \
-            torch.tensor(self.samples['post_sample_means']['gamma_g']) * \
-            self.samples['post_sample_means']['mu_expression'][...,1]
+            adata.layers['velocity'] = compute_velocity(self.samples['post_sample_means']['beta_g'],
+                                                        self.samples['post_sample_means']['gamma_g'],
+                                                        self.samples['post_sample_means']['mu_expression'])
             scv.pp.neighbors(adata)
             scv.tl.velocity_graph(adata, vkey = 'velocity')
             scv.tl.velocity_embedding(adata, vkey = 'velocity')
@@ -722,7 +765,7 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
                     torch.tensor(np.mean(self.samples['post_sample_means']['T_mON'][:,:,m])),
                     torch.tensor(np.mean(self.samples['post_sample_means']['T_mOFF'][:,:,m])),
                     torch.zeros((self.module.model.n_obs, self.module.model.n_vars)))[...,1], axis = -1)
-            ax.scatter(self.samples['post_sample_means']['T_c'][:,:,0].flatten() - np.min(self.samples['post_sample_means']['T_c'][:,:,0].flatten()), abundance, s = 10, label = 'Module ' + str(m))
+            ax.scatter(self.samples['post_sample_means']['T_c'][:,:,0].ravel() - np.min(self.samples['post_sample_means']['T_c'][:,:,0]), abundance, s = 10, label = 'Module ' + str(m))
             ax.set_xlabel('Time (hours)')
             ax.set_ylabel('Total Spliced UMI Counts')
             if time_max or time_min > 0:
@@ -743,8 +786,10 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         save
             Whether to save the plot.
         """
+        # batch codes are static after setup_anndata, no need to scan adata.obs for them:
+        batches = [str(x) for x in range(self.summary_stats["n_batch"])]
         fig, ax = plt.subplots(3, 2, figsize = (12, 9))
-        ax[0,0].scatter([str(x) for x in np.unique(adata.obs['_scvi_batch'])],
+        ax[0,0].scatter(batches,
                       self.samples['post_sample_means']['detection_mean_y_e'], s = 150, c = 'black')
         ax[0,0].set_xlabel('Batch Number')
         ax[0,0].set_ylabel('Relative Detection Efficiency')
@@ -758,10 +803,10 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         ax[0,1].set_xlabel('Relative Detection Efficiency')
         ax[0,1].set_ylabel('Number of Cells')
         ax[0,1].set_title('Relative Detection Efficiency across cells')
-        ax[1,0].scatter([str(x) for x in np.unique(adata.obs['_scvi_batch'])],
+        ax[1,0].scatter(batches,
                       self.samples['post_sample_means']['s_g_gene_add_mean'][...,0],
                       s = 150, c = 'red', label = 'unspliced')
-        ax[1,0].scatter([str(x) for x in np.unique(adata.obs['_scvi_batch'])],
+        ax[1,0].scatter(batches,
                       self.samples['post_sample_means']['s_g_gene_add_mean'][...,1],
                       s = 150, c = 'blue', label = 'spliced')
         ax[1,0].legend(frameon=False)
@@ -837,6 +882,7 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
             - **List:** List of DataFrames containing enriched GO terms for each module.
         """
 
+        import gseapy as gp
         
         tab = pd.DataFrame(columns = ('Module Number', 'Genes Ranked', 'TFs Ranked', 'Terms Ranked'))
         tab['Module Number'] = list(range(self.module.model.n_modules))
@@ -849,18 +895,23 @@ class Cell2fate_DynamicalModel(QuantileMixin, PyroSampleMixin, PyroSviTrainMixin
         gene_by_module_sorted = np.empty((self.module.model.n_modules, self.module.model.n_vars), dtype=object)
         TF_by_module_sorted = np.empty((self.module.model.n_modules, len(TFs)), dtype=object)
         TF_boolean = np.array([g in TFs for g in adata.var_names])
-        inferred_total = torch.sum(torch.tensor(self.samples['post_sample_means']['mu_expression'])[...,1], axis = 0)
+        post_means = self.samples['post_sample_means']
+        inferred_total = torch.sum(torch.tensor(post_means['mu_expression'])[...,1], axis = 0)
+        beta_g = torch.tensor(post_means['beta_g'])
+        gamma_g = torch.tensor(post_means['gamma_g'])
+        T_c = torch.tensor(post_means['T_c'][:,:,0])
+        zeros = torch.zeros((self.module.model.n_obs, self.module.model.n_vars))
         for m in range(self.module.model.n_modules):
             mu_m = mu_mRNA_continousAlpha_globalTime_twoStates(
-                torch.tensor(self.samples['post_sample_means']['A_mgON'][m,:]),
+                torch.tensor(post_means['A_mgON'][m,:]),
                 torch.tensor(0.),
-                torch.tensor(self.samples['post_sample_means']['beta_g']),
-                torch.tensor(self.samples['post_sample_means']['gamma_g']),
-                torch.tensor(self.samples['post_sample_means']['lam_mi'][m,:]),
-                torch.tensor(self.samples['post_sample_means']['T_c'][:,:,0]),
-                torch.tensor(self.samples['post_sample_means']['T_mON'][:,:,m]),
-                torch.tensor(self.samples['post_sample_means']['T_mOFF'][:,:,m]),
-                torch.zeros((self.module.model.n_obs, self.module.model.n_vars)))
+                beta_g,
+                gamma_g,
+                torch.tensor(post_means['lam_mi'][m,:]),
+                T_c,
+                torch.tensor(post_means['T_mON'][:,:,m]),
+                torch.tensor(post_means['T_mOFF'][:,:,m]),
+                zeros)
             gene_by_module_weight[m,:] = torch.sum(mu_m[...,1], axis = 0)/inferred_total
             gene_by_module_sorted[m,:] = adata.var_names[np.argsort(-1*gene_by_module_weight[m,:])]
             TF_by_module_sorted[m,:] = adata.var_names[TF_boolean][np.argsort(-1*gene_by_module_weight[m,TF_boolean])]
@@ -1,46 +1,11 @@
-from typing import List, Optional
-from datetime import date
-import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
 from anndata import AnnData
 import torch
 from pyro import clear_param_store
-from scvi.model._utils import parse_use_gpu_arg
-from scvi.dataloaders import AnnDataLoader
-from scvi.utils import track
-from scvi import REGISTRY_KEYS
-from scvi.data import AnnDataManager
-from scvi.data.fields import (
-    CategoricalObsField,
-    LayerField,
-    NumericalJointObsField,
-    NumericalObsField,
-)
-from scvi.model.base import BaseModelClass, PyroSampleMixin, PyroSviTrainMixin
-from scvi.utils import setup_anndata_dsp
-import pyro.distributions as dist
-import scanpy as sc
-import contextlib
-import io
-from numpy.linalg import norm
-from scipy.sparse import csr_matrix
-from numpy import inner
-import scvelo as scv
-from scvelo.plotting.velocity_embedding_grid import compute_velocity_on_grid
-from ._velocity_embedding_stream import velocity_embedding_stream_modules
-import scipy
-import gseapy as gp
 from cell2fate._pyro_base_cell2fate_module import Cell2FateBaseModule
-from cell2fate._pyro_mixin import QuantileMixin
 from ._cell2fate_DynamicalModel_amortized_module import \
 Cell2fate_DynamicalModel_amortized_module
 from ._cell2fate_DynamicalModel import \
 Cell2fate_DynamicalModel
-from cell2fate.utils import multiplot_from_generator
-from cell2fate.utils import mu_mRNA_continousAlpha_globalTime_twoStates
-import cell2fate as c2f
 from cell2fate._pyro_mixin import PyroTrainingPlan_ClippedAdamDecayingRate
 
 class Cell2fate_DynamicalModel_amortized(Cell2fate_DynamicalModel):
@@ -7,7 +7,6 @@ from pyro.nn import PyroModule
 import torch
 from scvi import REGISTRY_KEYS
 import pandas as pd
-from scvi.nn import one_hot
 from cell2fate.utils import G_a, G_b, mu_mRNA_continousAlpha_globalTime_twoStates
 from pyro.infer import config_enumerate
 from pyro.ops.indexing import Vindex
@@ -64,7 +63,8 @@ class Cell2fate_DynamicalModel_amortized_module(Cell2fate_DynamicalModel_module)
     def forward(self, x_data, idx, batch_index):
         
         batch_size = len(idx)
-        obs2sample = one_hot(batch_index, self.n_batch)        
+        # batch of each cell as an integer index (gather instead of one-hot matmul):
+        obs2sample = batch_index.reshape(-1).long()
         obs_plate = self.create_plates(x_data, idx, batch_index)
         
         # ===================== Kinetic Rates ======================= #
@@ -139,10 +139,11 @@ class Cell2fate_DynamicalModel_amortized_module(Cell2fate_DynamicalModel_module)
         T_mOFF = pyro.deterministic('T_mOFF', T_mON + T_max*t_mOFF)
         
         # =========== Mean expression according to RNAvelocity model ======================= #
-        mu_total = torch.stack([self.zeros[idx,...], self.zeros[idx,...]], axis = -1)
+        zeros = self.zeros[idx,...]
+        mu_total = torch.stack([zeros, zeros], axis = -1)
         for m in range(self.n_modules):
             mu_total += mu_mRNA_continousAlpha_globalTime_twoStates(
-                A_mgON[m,:], A_mgOFF, beta_g, gamma_g, lam_mi[m,...], T_c[:,:,0], T_mON[:,:,m], T_mOFF[:,:,m], self.zeros[idx,...])
+                A_mgON[m,:], A_mgOFF, beta_g, gamma_g, lam_mi[m,...], T_c[:,:,0], T_mON[:,:,m], T_mOFF[:,:,m], zeros)
         with obs_plate:
             mu_expression = pyro.deterministic('mu_expression', mu_total)
         
@@ -162,7 +163,7 @@ class Cell2fate_DynamicalModel_amortized_module(Cell2fate_DynamicalModel_module)
             self.detection_hyp_prior_alpha,
         )
 
-        beta = detection_hyp_prior_alpha / (obs2sample @ detection_mean_y_e)
+        beta = detection_hyp_prior_alpha / detection_mean_y_e[..., obs2sample, :]
         with obs_plate:
             detection_y_c = pyro.sample(
                 "detection_y_c",
@@ -236,7 +237,7 @@ class Cell2fate_DynamicalModel_amortized_module(Cell2fate_DynamicalModel_module)
         # =====================Expected expression ======================= #
         # biological expression
         with obs_plate:
-            mu = pyro.deterministic('mu', (mu_expression + torch.einsum('cbi,bgi->cgi', obs2sample.unsqueeze(dim=-1), s_g_gene_add)) * \
+            mu = pyro.deterministic('mu', (mu_expression + s_g_gene_add[..., obs2sample, :, :]) * \
         detection_y_c * detection_y_i * detection_y_gi)
         
         # =====================DATA likelihood ======================= #
@@ -4,7 +4,6 @@ import numpy as np
 import pyro
 import pandas as pd
 import scanpy as sc
-import random
 import scvelo as scv
 from numpy.linalg import norm
 import scipy
@@ -17,6 +16,10 @@ import os,sys
 import cell2fate as c2f
 
 import torch
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 
 def robust_optimization(mod, save_dir, max_epochs = [200, 400], lr = [0.01, 0.01], use_gpu = True):
     """
@@ -195,32 +198,25 @@ def compute_velocity_graph_Bergen2020(adata, n_neighbours = None, full_posterior
         n_neighbours = int(np.round(M*0.05, 0))
     scv.pp.neighbors(adata, n_neighbors = n_neighbours)
     adata.obsp['binary'] = adata.obsp['connectivities'] != 0
-    distances = []
-    velocities = []
-    cosines = []
-    transition_probabilities = []
-    matrices = []
-    if full_posterior:
-        for i in range(M):
-            distances += [adata.layers[spliced_key][adata.obsp['binary'].toarray()[i,:],:] - adata.layers[spliced_key][i,:].flatten()]
-            velocities += [adata.uns['velocity_posterior'][:,i,:]]
-            cosines += [inner(distances[i], velocities[i])/(norm(distances[i])*norm(velocities[i]))]
-            transition_probabilities += [np.exp(2*cosines[i])]
-            transition_probabilities[i] = transition_probabilities[i]/np.sum(transition_probabilities[i], axis = 0)
-            matrices += [csr_matrix((np.mean(np.array(transition_probabilities[i]), axis = 1),
-                    (np.repeat(i, len(transition_probabilities[i])), np.where(adata.obsp['binary'][i,:].toarray())[1])),
-                                   shape=(M, M))]
-    else:
-        for i in range(M):
-            distances += [adata.layers[spliced_key][adata.obsp['binary'].toarray()[i,:],:] - adata.layers[spliced_key][i,:].flatten()]
-            velocities += [adata.layers['velocity'][i,:].reshape(1,len(adata.var_names))]
-            cosines += [inner(distances[i], velocities[i])/(norm(distances[i])*norm(velocities[i]))]
-            transition_probabilities += [np.exp(2*cosines[i])]
-            transition_probabilities[i] = transition_probabilities[i]/np.sum(transition_probabilities[i], axis = 0)
-            matrices += [csr_matrix((np.mean(np.array(transition_probabilities[i]), axis = 1),
-                    (np.repeat(i, len(transition_probabilities[i])), np.where(adata.obsp['binary'][i,:].toarray())[1])),
-                                   shape=(M, M))]
-    return sum(matrices)
+    binary = csr_matrix(adata.obsp['binary'])
+    rows = []
+    cols = []
+    values = []
+    for i in range(M):
+        # neighbours of cell i read from the sparse graph (avoids densifying the M x M graph):
+        neighbours = binary.indices[binary.indptr[i]:binary.indptr[i+1]]
+        distances = adata.layers[spliced_key][neighbours,:] - adata.layers[spliced_key][i,:].flatten()
+        if full_posterior:
+            velocities = adata.uns['velocity_posterior'][:,i,:]
+        else:
+            velocities = adata.layers['velocity'][i,:].reshape(1,len(adata.var_names))
+        cosines = inner(distances, velocities)/(norm(distances)*norm(velocities))
+        transition_probabilities = np.exp(2*cosines)
+        transition_probabilities = transition_probabilities/np.sum(transition_probabilities, axis = 0)
+        rows += [np.repeat(i, len(transition_probabilities))]
+        cols += [neighbours]
+        values += [np.mean(transition_probabilities, axis = 1)]
+    return csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(M, M))
 
 def plot_velocity_umap_Bergen2020(adata, use_full_posterior = True, n_neighbours = None,
                                   plotting_kwargs = None, save = False, spliced_key = 'Ms'):
@@ -267,7 +263,7 @@ def plot_velocity_umap_Bergen2020(adata, use_full_posterior = True, n_neighbours
         scv.pl.velocity_embedding_stream(adata, basis='umap', save = save, **plotting_kwargs)
 
 def get_training_data(adata, remove_clusters = None, cells_per_cluster = 100,
-                         cluster_column = 'clusters', min_shared_counts = 10, n_var_genes = 2000):
+                         cluster_column = 'clusters', min_shared_counts = 10, n_var_genes = 2000, seed = 1):
     """
     Reduces and anndata object to the most relevant cells and genes for understanding the differentiation trajectories
     in the data.
@@ -287,22 +283,25 @@ def get_training_data(adata, remove_clusters = None, cells_per_cluster = 100,
         Minimum number of spliced+unspliced counts across all cells for a gene to be retained
     n_var_genes
         Number of top variable genes to retain
+    seed
+        Seed for the random subsampling of cells in each cluster
         
     Returns
     -------
     AnnData
         AnnData object reduced to the most informative cells and genes
     """
-    random.seed(a=1)
+    rng = np.random.default_rng(seed)
     adata = adata[[c not in remove_clusters for c in adata.obs[cluster_column]], :]
     # Restrict samples per cell type:
     N = cells_per_cluster
     unique_celltypes = np.unique(adata.obs[cluster_column])
+    cluster_sizes = adata.obs[cluster_column].value_counts()
     index = []
     for i in range(len(unique_celltypes)):
-        if adata.obs[cluster_column].value_counts()[unique_celltypes[i]] > N:
+        if cluster_sizes[unique_celltypes[i]] > N:
             subset = np.where(adata.obs[cluster_column] == unique_celltypes[i])[0]
-            subset = random.sample(list(subset), N)
+            subset = rng.choice(subset, N, replace = False)
         else:
             subset = np.where(adata.obs[cluster_column] == unique_celltypes[i])[0]
         index += list(subset)
@@ -311,10 +310,11 @@ def get_training_data(adata, remove_clusters = None, cells_per_cluster = 100,
     scv.pp.filter_genes(adata, min_shared_counts=min_shared_counts)
     sc.pp.normalize_total(adata, target_sum=1e4)
     scv.pp.filter_genes_dispersion(adata, n_top_genes=n_var_genes)
-    if scipy.sparse.issparse(adata.layers['spliced']):
-        adata.layers['spliced'] = np.array(adata.layers['spliced'].toarray(), dtype=np.float32)
-    if scipy.sparse.issparse(adata.layers['unspliced']):
-        adata.layers['unspliced'] = np.array(adata.layers['unspliced'].toarray(), dtype=np.float32)
+    for layer in ['spliced', 'unspliced']:
+        if scipy.sparse.issparse(adata.layers[layer]):
+            adata.layers[layer] = adata.layers[layer].astype(np.float32).toarray()
+        else:
+            adata.layers[layer] = np.asarray(adata.layers[layer], dtype=np.float32)
     return adata
 
 def G_a(mu, sd):
@@ -471,3 +471,35 @@ def mu_mRNA_continousAlpha_globalTime_twoStates(alpha_ON, alpha_OFF, beta, gamma
     mu_RNAvelocity = torch.clip(mu_mRNA_continuousAlpha(alpha_cg, beta, gamma, tau_cg,
                                                          u0_g, s0_g, delta_alpha, lam_g), min = 10**(-5))
     return mu_RNAvelocity
+
+def compute_velocity(beta_g, gamma_g, mu_expression):
+    '''
+    Calculates RNA velocity (expected gradient of spliced counts) from splicing and degradation rates
+    and expected unspliced and spliced counts. Uses ``numexpr`` (if installed) to evaluate the expression
+    in a single blocked pass without cells x genes temporaries.
+
+    Parameters
+    ----------
+    beta_g
+        Splicing rate of each gene.
+    gamma_g
+        Degradation rate of each gene.
+    mu_expression
+        Expected unspliced and spliced counts (cells x genes x 2).
+
+    Returns
+    -------
+    Numpy.ndarray
+        RNA velocity for each cell and gene.
+    '''
+
+    beta_g = np.asarray(beta_g)
+    gamma_g = np.asarray(gamma_g)
+    mu_u = np.asarray(mu_expression[...,0])
+    mu_s = np.asarray(mu_expression[...,1])
+    if ne is not None:
+        return ne.evaluate('beta_g * mu_u - gamma_g * mu_s')
+    # subtract in place to keep a single cells x genes temporary:
+    velocity = np.multiply(beta_g, mu_u)
+    np.subtract(velocity, np.multiply(gamma_g, mu_s), out = velocity)
+    return velocity
@@ -132,6 +132,20 @@ def test_cell2fate():
     # test train the model with one epoch using a specific batch size
     mod.train(max_epochs=5, batch_size=10, accelerator=accelerator)
     
+    # test train the model with a jit-compiled ELBO
+    mod.train(max_epochs=2, jit=True, accelerator=accelerator)
+    
+    # test jit with a batch size that leaves an uneven last minibatch
+    mod.train(max_epochs=2, jit=True, batch_size=40, accelerator=accelerator)
+    assert np.all(np.isfinite(mod.history["elbo_train"].values))
+    
+    # test train the model with several particles and mean field ELBO
+    mod.train(max_epochs=2, num_particles=2, mean_field=True, accelerator=accelerator)
+    
+    # test jit with several particles and mean field ELBO on uneven minibatches
+    mod.train(max_epochs=2, num_particles=2, mean_field=True, jit=True, batch_size=40, accelerator=accelerator)
+    assert np.all(np.isfinite(mod.history["elbo_train"].values))
+    
     #test robust optimization
     mod = c2f.utils.robust_optimization(mod,save_path, use_gpu = use_gpu, max_epochs = [1,2])
     
@@ -228,4 +242,79 @@ def test_cell2fate():
     
     # test export of posterior quantiles from amortized model
     adata_posterior_amortized = mod_amortised.export_posterior_quantiles(adata_train, use_gpu = use_gpu)
-    
\ No newline at end of file
+    
+
+def test_compute_velocity(monkeypatch):
+    
+    rng = np.random.default_rng(0)
+    beta_g = rng.gamma(2., size=(1, 7)).astype(np.float32)
+    gamma_g = rng.gamma(2., size=(1, 7)).astype(np.float32)
+    mu_expression = rng.gamma(2., size=(5, 7, 2)).astype(np.float32)
+    expected = beta_g*mu_expression[...,0] - gamma_g*mu_expression[...,1]
+    
+    # test numexpr path (if installed)
+    if c2f.utils.ne is not None:
+        np.testing.assert_allclose(c2f.utils.compute_velocity(beta_g, gamma_g, mu_expression), expected, rtol=1e-6)
+    
+    # test numpy fallback
+    monkeypatch.setattr(c2f.utils, "ne", None)
+    velocity = c2f.utils.compute_velocity(beta_g, gamma_g, mu_expression)
+    assert velocity.shape == (5, 7)
+    np.testing.assert_allclose(velocity, expected, rtol=1e-6)
+
+
+def dense_mask_velocity_graph(adata, full_posterior, spliced_key, velocity_key):
+    """Reference implementation of the velocity graph using dense neighbour masks and a sum of per-cell matrices."""
+    from numpy import inner
+    from numpy.linalg import norm
+    from scipy.sparse import csr_matrix
+    M = len(adata.obs_names)
+    matrices = []
+    for i in range(M):
+        distances = adata.layers[spliced_key][adata.obsp['binary'].toarray()[i,:],:] - adata.layers[spliced_key][i,:].flatten()
+        if full_posterior:
+            velocities = adata.uns['velocity_posterior'][:,i,:]
+        else:
+            velocities = adata.layers[velocity_key][i,:].reshape(1,len(adata.var_names))
+        cosines = inner(distances, velocities)/(norm(distances)*norm(velocities))
+        transition_probabilities = np.exp(2*cosines)
+        transition_probabilities = transition_probabilities/np.sum(transition_probabilities, axis = 0)
+        matrices += [csr_matrix((np.mean(np.array(transition_probabilities), axis = 1),
+                (np.repeat(i, len(transition_probabilities)), np.where(adata.obsp['binary'][i,:].toarray())[1])),
+                               shape=(M, M))]
+    return sum(matrices)
+
+
+def test_compute_velocity_graph_Bergen2020(monkeypatch):
+    
+    from scipy.sparse import csr_matrix
+    rng = np.random.default_rng(0)
+    n_cells, n_genes, n_samples = 6, 4, 3
+    adata = ad.AnnData(X=rng.poisson(5, size=(n_cells, n_genes)).astype(np.float32))
+    adata.layers['Ms'] = rng.gamma(2., size=(n_cells, n_genes))
+    adata.layers['velocity'] = rng.normal(size=(n_cells, n_genes))
+    adata.uns['velocity_posterior'] = rng.normal(size=(n_samples, n_cells, n_genes))
+    # hand-built symmetric neighbour graph (ring plus one chord) with an explicit zero entry:
+    connectivities = np.zeros((n_cells, n_cells))
+    for i in range(n_cells):
+        connectivities[i, (i+1) % n_cells] = connectivities[(i+1) % n_cells, i] = rng.uniform(0.1, 1.)
+    connectivities[0, 3] = connectivities[3, 0] = 0.5
+    connectivities = csr_matrix(connectivities)
+    connectivities.data[connectivities.indices == 2] = 0.
+    adata.obsp['connectivities'] = connectivities
+    # keep the hand-built graph instead of recomputing neighbours:
+    monkeypatch.setattr(scv.pp, "neighbors", lambda *args, **kwargs: None)
+    adata.obsp['binary'] = adata.obsp['connectivities'] != 0
+    
+    for full_posterior in [True, False]:
+        expected = dense_mask_velocity_graph(adata, full_posterior, 'Ms', 'velocity').toarray()
+        
+        # test utils function
+        graph = c2f.utils.compute_velocity_graph_Bergen2020(adata, full_posterior = full_posterior, spliced_key = 'Ms')
+        np.testing.assert_allclose(graph.toarray(), expected)
+        
+        # test model method, reusing the existing neighbour graph
+        graph = c2f.Cell2fate_DynamicalModel.compute_velocity_graph_Bergen2020(
+            None, adata, full_posterior = full_posterior, spliced_key = 'Ms',
+            velocity_key = 'velocity', recompute_neighbours = False)
+        np.testing.assert_allclose(graph.toarray(), expected)